@@ -17,7 +17,8 @@ General
 
 Error handling
 - Always check the ret_code is 0
-- Otherwise, return the error (ret_msg)
+- Otherwise, log the error (ret_msg) and skip the response
+- Rate limit errors (RATE_LIMIT_CODES, HTTP 403/429) are retried by the governor
 
 Other
 ! Dual-Price Mechanism:
@@ -35,6 +36,8 @@ from loguru import logger
 
 from easydict import EasyDict as edict
 
+from ratelimit import RateLimitError, get_governor, parse_retry_after, LIMITS, PRIORITIES
+
 # TODO: Eliminate duplicate function and mapping
 def map_currency(currency, currency_map):
     """
@@ -67,7 +70,8 @@ BYBIT_BASE_ARGS = edict({'time': None,
                           'candles': 0,
                           'granularity': 60,
                           'trades': 0,
-                          'ticker': 0})
+                          'ticker': 0,
+                          'tier': 'public'})
 
 DEBUG = False
 API_LINK = 'https://api-testnet.bybit.com/v2/public/'
@@ -76,6 +80,8 @@ LIMIT = 500
 DEPTH = 10
 INTERVAL = '1'
 SINCE = '1581231260'
+RATE_LIMIT_CODES = (10006, 10018)  # too many visits, exceeded the IP rate limit
+REQUEST_TIMEOUT = 10
 
 
 def get_order_book(pair=PAIR, depth=DEPTH, debug=DEBUG):
@@ -133,19 +139,25 @@ FN_MAPPING = {
 }
 
 
-def store_info(save_dir, pair, pair_save_name, collection_time, info_type, **kwargs):
+def store_info(save_dir, pair, pair_save_name, collection_time, info_type, tier='public', **kwargs):
     """
     Logs API request response by
         info_type: FN_MAPPING.keys()
         timestamp: Unix time of request
+    Requests are rate limited by the governor shared by all bybit collectors of the API key tier
     """
     logger.info(f'Collecting {info_type} data for {pair_save_name}')
+    governor = get_governor('bybit', tier)
     with open(join(save_dir, info_type) + '.txt', 'w') as file:
         start = time.time()
         while time.time() - start < collection_time:
+            ts, response = governor.call(FN_MAPPING[info_type], priority=PRIORITIES[info_type],
+                                         pair=pair, **kwargs)
+            if response is None:  # error, logged by make_request or the governor
+                continue
             file.write(json.dumps({
-                'ts': time.time(),
-                'response': FN_MAPPING[info_type](pair=pair, **kwargs)
+                'ts': ts,
+                'response': response
             }))
             file.write('\n')
 
@@ -185,6 +197,10 @@ def parse_arguments():
     # Ticker
     parser.add_argument('--ticker', type=int, default=0,
                         help='Gets snapshot information about the last trade (tick), best bid/ask and 24h volume.')
+    # Rate limit
+    parser.add_argument('--tier', type=str, default='public', choices=list(LIMITS['bybit'].keys()),
+                        help='API key tier, determines the rate limit shared by all requests. '
+                             'Only public endpoints are collected, so only the per-IP public limit applies.')
 
     parser_args = parser.parse_args()
 
@@ -209,6 +225,8 @@ def main(args):
     use_trades = args.trades
     # Ticker
     use_ticker = args.ticker
+    # Rate limit
+    tier = args.tier
 
     save_dir = join(*[args.savedir, pair_save_name, 'bybit'])
     os.makedirs(save_dir, exist_ok=True)
@@ -216,9 +234,9 @@ def main(args):
 
     threads = []
     if use_ticker:
-        make_thread(threads, default_args, 'ticker', {})
+        make_thread(threads, default_args, 'ticker', {'tier': tier})
     if use_ob:
-        make_thread(threads, default_args, 'order_book', {'depth': depth})
+        make_thread(threads, default_args, 'order_book', {'depth': depth, 'tier': tier})
     # if use_spreads:
     #     t = threading.Thread(
     #         target=store_info,
@@ -226,10 +244,10 @@ def main(args):
     #     )
     #     threads.append(t)
     if use_trades:
-        make_thread(threads, default_args, 'trades', {})
+        make_thread(threads, default_args, 'trades', {'tier': tier})
     if use_candles:
         make_thread(threads, default_args, 'candles', {
-                    'granularity': candles_granularity})
+                    'granularity': candles_granularity, 'tier': tier})
 
     for t in threads:
         t.start()
@@ -245,14 +263,26 @@ if __name__ == "__main__":
 def make_request(url, debug=DEBUG):
     """
     Makes a request and handles the response
-    Returns result or error message
+    Returns result, or None on error
+    Raises RateLimitError if Bybit rejected the request for its rate
+    Raises requests.RequestException on connection errors, timeouts and HTTP errors
     """
     if debug:
         logger.info(f'GET {url}')
-    resp = requests.get(url).json()
+    resp = requests.get(url, timeout=REQUEST_TIMEOUT)
+    retry_after = parse_retry_after(resp.headers)
+    if resp.status_code in (403, 429):  # 403 is returned when the IP rate limit is exceeded
+        raise RateLimitError(retry_after)
+    resp.raise_for_status()
+    resp = resp.json()
+    if resp['ret_code'] in RATE_LIMIT_CODES:
+        if retry_after is None and 'rate_limit_reset_ms' in resp:
+            retry_after = max(resp['rate_limit_reset_ms'] / 1000 - time.time(), 0)
+        raise RateLimitError(retry_after)
     if resp['ret_code'] == 0:
         return resp['result']
-    return resp['ret_msg']
+    logger.warning(f'GET {url} failed: {resp["ret_msg"]}')
+    return None
 
 
 def make_thread(threads, args, function, kwargs):
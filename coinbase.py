@@ -13,6 +13,8 @@ from loguru import logger
 
 from easydict import EasyDict as edict
 
+from ratelimit import RateLimitError, get_governor, LIMITS, PRIORITIES
+
 CBPRO_BASE_ARGS = edict({'time': None,
                           'pair': None,
                          'savedir': None,
@@ -23,20 +25,39 @@ CBPRO_BASE_ARGS = edict({'time': None,
                           'granularity': 60,
                           'stats': 0,
                           'trades': 0,
-                          'ticker': 0})
+                          'ticker': 0,
+                          'tier': 'public'})
 
 BASE_SAVE_DIR = '../../datasets/'
 PUBLIC_CLIENT = cbpro.PublicClient()
 
 
+def make_request(fn, **kwargs):
+    """
+    Calls a FN_MAPPING function (a PublicClient method) and handles the response
+    cbpro returns errors as {'message': ...} and hides the HTTP status
+    Returns the response, or None on error
+    Raises RateLimitError if Coinbase rejected the request for its rate
+    cbpro raises requests.RequestException on connection errors and timeouts (30s)
+    """
+    response = fn(**kwargs)
+    if isinstance(response, dict) and 'message' in response:
+        if 'rate limit' in response['message'].lower():
+            raise RateLimitError()
+        logger.warning(f'{fn.__name__} failed: {response["message"]}')
+        return None
+    return response
+
+
 def get_product_order_book(product_id, level=2, depth=10):
     """
     Buffer function to avoid getting a huge order book for nothing
     TODO: make this a real buffer so as to avoid losing info from the API because of processing time
     """
     response = PUBLIC_CLIENT.get_product_order_book(product_id=product_id, level=level)
-    response['bids'] = response['bids'][:depth]
-    response['asks'] = response['asks'][:depth]
+    if 'message' not in response:  # errors are handled by make_request
+        response['bids'] = response['bids'][:depth]
+        response['asks'] = response['asks'][:depth]
     return response
 
 
@@ -49,19 +70,25 @@ FN_MAPPING = {
 }
 
 
-def store_info(save_dir, pair, collection_time, info_type, **kwargs):
+def store_info(save_dir, pair, collection_time, info_type, tier='public', **kwargs):
     """
     Logs API request response by
         info_type: FN_MAPPING.keys()
         timestamp: Unix time of request
+    Requests are rate limited by the governor shared by all cb_pro collectors of the API key tier
     """
     logger.info(f'Collecting {info_type} data for {pair}')
+    governor = get_governor('cb_pro', tier)
     with open(join(save_dir, info_type) + '.txt', 'w') as file:
         start = time.time()
         while time.time() - start < collection_time:
+            ts, response = governor.call(make_request, FN_MAPPING[info_type], priority=PRIORITIES[info_type],
+                                         product_id=pair, **kwargs)
+            if response is None:  # error, logged by make_request or the governor
+                continue
             file.write(json.dumps({
-                'ts': time.time(),
-                'response': FN_MAPPING[info_type](product_id=pair, **kwargs)
+                'ts': ts,
+                'response': response
                 }))
             file.write('\n')
 
@@ -103,6 +130,10 @@ def parse_arguments():
     # Ticker
     parser.add_argument('--ticker', type=int, default=0,
                         help='Gets snapshot information about the last trade (tick), best bid/ask and 24h volume.')
+    # Rate limit
+    parser.add_argument('--tier', type=str, default='public', choices=list(LIMITS['cb_pro'].keys()),
+                        help='API key tier, determines the rate limit shared by all requests. '
+                             'Only public endpoints are collected, so only the per-IP public limit applies.')
 
     parser_args = parser.parse_args()
 
@@ -126,6 +157,8 @@ def main(args):
     use_trades = args.trades
     # Ticker
     use_ticker = args.ticker
+    # Rate limit
+    tier = args.tier
 
     save_dir = join(*[args.savedir, pair, 'cb_pro'])
     os.makedirs(save_dir, exist_ok=True)
@@ -133,6 +166,7 @@ def main(args):
     if use_ticker:
         t = threading.Thread(target=store_info,
                              args=(save_dir, pair, collection_time, 'ticker'),
+                             kwargs={'tier': tier}
                              )
         threads.append(t)
 
@@ -140,26 +174,29 @@ def main(args):
         t = threading.Thread(target=store_info,
                              args=(save_dir, pair, collection_time, 'order_book'),
                              kwargs={'level': ob_level,
-                                     'depth': ob_depth}
+                                     'depth': ob_depth,
+                                     'tier': tier}
                              )
         threads.append(t)
 
     if use_stats:
         t = threading.Thread(target=store_info,
                              args=(save_dir, pair, collection_time, 'stats'),
+                             kwargs={'tier': tier}
                              )
         threads.append(t)
 
     if use_trades:
         t = threading.Thread(target=store_info,
                              args=(save_dir, pair, collection_time, 'trades'),
+                             kwargs={'tier': tier}
                              )
         threads.append(t)
 
     if use_candles:
         t = threading.Thread(target=store_info,
                              args=(save_dir, pair, collection_time, 'candles'),
-                             kwargs={'granularity': candles_granularity}
+                             kwargs={'granularity': candles_granularity, 'tier': tier}
                              )
         threads.append(t)
 
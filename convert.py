@@ -0,0 +1,512 @@
+"""
+This module converts the JSON-lines files written by the collectors into
+normalized, columnar Parquet files
+
+General
+- Input tree (as written by kraken.py, bybit.py and coinbase.py):
+  <srcdir>/<pair>/<exchange>/<info_type>.txt
+  where every line is {"ts": <unix time>, "response": <api response>}
+- Output tree:
+  <outdir>/<pair>/<exchange>/<info_type>/part-<start>-<end>.parquet
+  where start/end is the byte range of the source file the part was built from
+- The stored response differs by exchange:
+  kraken - the inner value of "result" (the pair key is dropped)
+  bybit  - "result", or the "ret_msg" string on error
+  cb_pro - the raw cbpro response
+- Every info_type is normalized to one schema (SCHEMAS) regardless of exchange,
+  one row per price level / trade / candle / snapshot
+
+Work distribution
+- Large files are split in byte ranges of --chunk_mb, aligned to newlines.
+  A line belongs to the range it starts in.
+- Ranges are converted in a process pool, each one streamed and written
+  in row groups of --batch_lines source lines.
+- Every part is written to a temporary file and renamed once complete, so an
+  interrupted run can be resumed: existing parts are verified and skipped.
+- Parts not in the current plan (the source grew, was re-collected or
+  --chunk_mb changed) are deleted, so every source byte is in exactly one part.
+
+Verification
+- Lines are either converted, error responses stored by the collectors
+  (is_error_response) or failures: truncated lines and responses the
+  normalizer could not handle. Failures are logged with a sample, and a part
+  with more than --max_failure_rate failures is not written.
+- Before a part is written, its line count is checked against the number of
+  newline-delimited records in its byte range and its row count against the
+  Parquet footer.
+- Each part stores the size and mtime of its source file and its counts in its
+  Parquet key-value metadata. On resume, a part is valid if its source file has
+  not changed since and the row count in the footer matches the recorded one.
+"""
+
+import os
+import sys
+from os.path import join
+import json
+import argparse
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from loguru import logger
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+BASE_SAVE_DIR = '../../datasets/'
+BASE_OUT_DIR = '../../datasets_parquet/'
+CHUNK_MB = 256
+BATCH_LINES = 10000
+MAX_FAILURE_RATE = 0.001
+READ_BLOCK_BYTES = 1024 * 1024
+
+NAN = float('nan')
+BID, ASK = 0, 1
+BUY, SELL, UNKNOWN_SIDE = 0, 1, -1
+
+SCHEMAS = {
+    'order_book': pa.schema([('ts', pa.float64()),
+                             ('side', pa.int8()),
+                             ('level', pa.int16()),
+                             ('price', pa.float64()),
+                             ('size', pa.float64())]),
+    'trades': pa.schema([('ts', pa.float64()),
+                         ('trade_ts', pa.float64()),
+                         ('side', pa.int8()),
+                         ('price', pa.float64()),
+                         ('size', pa.float64())]),
+    'candles': pa.schema([('ts', pa.float64()),
+                          ('open_time', pa.float64()),
+                          ('open', pa.float64()),
+                          ('high', pa.float64()),
+                          ('low', pa.float64()),
+                          ('close', pa.float64()),
+                          ('volume', pa.float64())]),
+    'ticker': pa.schema([('ts', pa.float64()),
+                         ('price', pa.float64()),
+                         ('bid', pa.float64()),
+                         ('ask', pa.float64()),
+                         ('volume', pa.float64())]),
+    'spread': pa.schema([('ts', pa.float64()),
+                         ('spread_ts', pa.float64()),
+                         ('bid', pa.float64()),
+                         ('ask', pa.float64())]),
+    'stats': pa.schema([('ts', pa.float64()),
+                        ('open', pa.float64()),
+                        ('high', pa.float64()),
+                        ('low', pa.float64()),
+                        ('last', pa.float64()),
+                        ('volume', pa.float64())]),
+}
+
+
+### Normalizers ###
+# Each normalizer returns the list of rows (tuples in SCHEMAS order) for one
+# stored response. Error responses raise and are counted as errored lines.
+
+
+def iso_to_unix(iso_time):
+    """
+    Returns the unix time of an ISO 8601 timestamp (e.g. 2020-01-12T11:37:43.000Z)
+    """
+    return datetime.fromisoformat(iso_time.replace('Z', '+00:00')).timestamp()
+
+
+def book_levels(ts, response):
+    """
+    Order book of the form {'bids': [[price, size, ...]], 'asks': [...]}
+    Used by kraken and cb_pro
+    """
+    rows = []
+    for side, key in ((BID, 'bids'), (ASK, 'asks')):
+        for level, entry in enumerate(response[key]):
+            rows.append((ts, side, level, float(entry[0]), float(entry[1])))
+    return rows
+
+
+def kraken_trades(ts, response):
+    """Trades of the form [[price, volume, time, buy/sell, market/limit, misc]]"""
+    return [(ts, float(t[2]), BUY if t[3] == 'b' else SELL, float(t[0]), float(t[1]))
+            for t in response]
+
+
+def kraken_candles(ts, response):
+    """Candles of the form [[time, open, high, low, close, vwap, volume, count]]"""
+    return [(ts, float(c[0]), float(c[1]), float(c[2]), float(c[3]), float(c[4]), float(c[6]))
+            for c in response]
+
+
+def kraken_ticker(ts, response):
+    """Ticker of the form {'c': [last, lot], 'b': [bid, ...], 'a': [ask, ...], 'v': [today, 24h], ...}"""
+    return [(ts, float(response['c'][0]), float(response['b'][0]),
+             float(response['a'][0]), float(response['v'][1]))]
+
+
+def kraken_spreads(ts, response):
+    """Spreads of the form [[time, bid, ask]]"""
+    return [(ts, float(s[0]), float(s[1]), float(s[2])) for s in response]
+
+
+def bybit_order_book(ts, response):
+    """Order book of the form [{'price', 'size', 'side': Buy/Sell, ...}]"""
+    rows = []
+    levels = {BID: 0, ASK: 0}
+    for entry in response:
+        side = BID if entry['side'] == 'Buy' else ASK
+        rows.append((ts, side, levels[side], float(entry['price']), float(entry['size'])))
+        levels[side] += 1
+    return rows
+
+
+def bybit_trades(ts, response):
+    """Trades of the form [{'price', 'qty', 'side': Buy/Sell, 'time': ISO 8601, ...}]"""
+    return [(ts, iso_to_unix(t['time']), BUY if t['side'] == 'Buy' else SELL,
+             float(t['price']), float(t['qty']))
+            for t in response]
+
+
+def bybit_candles(ts, response):
+    """Candles of the form [{'open_time', 'open', 'high', 'low', 'close', 'volume', ...}]"""
+    return [(ts, float(c['open_time']), float(c['open']), float(c['high']),
+             float(c['low']), float(c['close']), float(c['volume']))
+            for c in response]
+
+
+def bybit_ticker(ts, response):
+    """Ticker is the last candle, so there is no bid/ask"""
+    return [(ts, float(c['close']), NAN, NAN, float(c['volume'])) for c in response]
+
+
+def cbpro_trades(ts, response):
+    """
+    Trades of the form [{'time': ISO 8601, 'price', 'size', 'side': buy/sell, ...}]
+    NOTE: side is the maker side
+    """
+    return [(ts, iso_to_unix(t['time']),
+             {'buy': BUY, 'sell': SELL}.get(t.get('side'), UNKNOWN_SIDE),
+             float(t['price']), float(t['size']))
+            for t in response]
+
+
+def cbpro_candles(ts, response):
+    """Candles of the form [[time, low, high, open, close, volume]]"""
+    return [(ts, float(c[0]), float(c[3]), float(c[2]), float(c[1]), float(c[4]), float(c[5]))
+            for c in response]
+
+
+def cbpro_ticker(ts, response):
+    """Ticker of the form {'price', 'bid', 'ask', 'volume', ...}"""
+    return [(ts, float(response['price']), float(response['bid']),
+             float(response['ask']), float(response['volume']))]
+
+
+def cbpro_stats(ts, response):
+    """24h stats of the form {'open', 'high', 'low', 'last', 'volume', ...}"""
+    return [(ts, float(response['open']), float(response['high']), float(response['low']),
+             float(response['last']), float(response['volume']))]
+
+
+def is_error_response(exchange, response):
+    """
+    Returns True if response is an error the collector stored instead of data
+    bybit  - the ret_msg string
+    cb_pro - {'message': ...}
+    kraken - never stored, the collector skips errors
+    """
+    if exchange == 'bybit':
+        return isinstance(response, str)
+    if exchange == 'cb_pro':
+        return isinstance(response, dict) and 'message' in response
+    return False
+
+
+NORMALIZER_MAPPING = {
+    'kraken': {
+        'order_book': book_levels,
+        'trades': kraken_trades,
+        'candles': kraken_candles,
+        'ticker': kraken_ticker,
+        'spread': kraken_spreads,
+    },
+    'bybit': {
+        'order_book': bybit_order_book,
+        'trades': bybit_trades,
+        'candles': bybit_candles,
+        'ticker': bybit_ticker,
+    },
+    'cb_pro': {
+        'order_book': book_levels,
+        'trades': cbpro_trades,
+        'candles': cbpro_candles,
+        'ticker': cbpro_ticker,
+        'stats': cbpro_stats,
+    },
+}
+
+
+### Planning ###
+
+
+def find_sources(src_dir):
+    """
+    Walks <src_dir>/<pair>/<exchange>/<info_type>.txt
+    Returns (pair, exchange, info_type, path) for every supported file
+    """
+    sources = []
+    for pair in sorted(os.listdir(src_dir)):
+        for exchange in sorted(NORMALIZER_MAPPING.keys()):
+            exchange_dir = join(src_dir, pair, exchange)
+            if not os.path.isdir(exchange_dir):
+                continue
+            for file_name in sorted(os.listdir(exchange_dir)):
+                info_type, ext = os.path.splitext(file_name)
+                if ext != '.txt':
+                    continue
+                if info_type not in NORMALIZER_MAPPING[exchange]:
+                    logger.warning(f'No normalizer for {exchange} {info_type}, skipping')
+                    continue
+                sources.append((pair, exchange, info_type, join(exchange_dir, file_name)))
+    return sources
+
+
+def split_ranges(path, chunk_bytes):
+    """
+    Splits a file in [start, end) byte ranges of roughly chunk_bytes
+    Every range starts at the beginning of a line and ends after a newline (or at EOF)
+    """
+    size = os.path.getsize(path)
+    ranges = []
+    with open(path, 'rb') as file:
+        start = 0
+        while start < size:
+            end = start + chunk_bytes
+            if end >= size:
+                end = size
+            else:
+                file.seek(end - 1)
+                file.readline()  # move past the newline ending the line at end - 1
+                end = file.tell()
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def count_records(path, start, end):
+    """
+    Returns the number of newline-delimited records in [start, end) of a file
+    The last record of a file may not end with a newline
+    """
+    records = 0
+    last = b''
+    with open(path, 'rb') as file:
+        file.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            block = file.read(min(READ_BLOCK_BYTES, remaining))
+            if not block:
+                break
+            records += block.count(b'\n')
+            last = block[-1:]
+            remaining -= len(block)
+    if last and last != b'\n':
+        records += 1
+    return records
+
+
+def part_path(out_dir, start, end):
+    return join(out_dir, f'part-{start:015d}-{end:015d}.parquet')
+
+
+### Conversion ###
+
+
+def source_stat(path):
+    """
+    Returns the size and mtime of a source file, stored in its parts to detect changes
+    """
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def read_part_metadata(path):
+    """
+    Returns the counts and source stat stored in a part's metadata and the row count of its footer
+    """
+    metadata = pq.read_metadata(path)
+    counts = json.loads(metadata.metadata[b'counts'])
+    source = json.loads(metadata.metadata[b'source_stat'])
+    return counts, source, metadata.num_rows
+
+
+def verify_part(path, source):
+    """
+    Returns True if the part exists, is complete, was built from the current
+    version of its source file and its row count is consistent
+    """
+    if not os.path.exists(path):
+        return False
+    try:
+        counts, part_source, num_rows = read_part_metadata(path)
+    except Exception as e:
+        logger.warning(f'Unreadable part {path}: {e}')
+        return False
+    return part_source == source and counts['rows'] == num_rows
+
+
+def remove_stale_parts(out_dir, planned_paths):
+    """
+    Deletes the parts and temporary files of out_dir that are not in planned_paths
+    """
+    for file_name in os.listdir(out_dir):
+        path = join(out_dir, file_name)
+        if file_name.startswith('part-') and path not in planned_paths:
+            logger.info(f'Removing stale part {path}')
+            os.remove(path)
+
+
+def write_batch(writer, schema, rows):
+    columns = list(zip(*rows))
+    writer.write_table(pa.Table.from_arrays(
+        [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+        schema=schema))
+
+
+def convert_range(src_path, source, exchange, info_type, start, end, dst_path,
+                  batch_lines=BATCH_LINES, max_failure_rate=MAX_FAILURE_RATE):
+    """
+    Converts the lines in [start, end) of src_path into a single Parquet part
+    source is the source_stat of src_path when the conversion was planned
+    The part is written to a temporary file and renamed once it passed verification
+    Returns the line and row counts
+    """
+    normalize = NORMALIZER_MAPPING[exchange][info_type]
+    schema = SCHEMAS[info_type]
+    counts = {'lines': 0, 'converted': 0, 'error_responses': 0, 'failures': 0, 'rows': 0}
+    first_failure = None
+    tmp_path = dst_path + '.tmp'
+
+    with open(src_path, 'rb') as file, pq.ParquetWriter(tmp_path, schema) as writer:
+        file.seek(start)
+        rows = []
+        batch = 0
+        while file.tell() < end:
+            line = file.readline()
+            counts['lines'] += 1
+            batch += 1
+            try:
+                record = json.loads(line)
+                if is_error_response(exchange, record['response']):
+                    counts['error_responses'] += 1
+                    line_rows = []
+                else:
+                    line_rows = normalize(record['ts'], record['response'])
+                    counts['converted'] += 1
+            except (ValueError, KeyError, TypeError, IndexError, AttributeError) as e:
+                # Truncated lines and responses the normalizer does not handle
+                counts['failures'] += 1
+                if first_failure is None:
+                    first_failure = f'{type(e).__name__}: {e} in {line[:200]!r}'
+            else:
+                rows.extend(line_rows)
+            if batch >= batch_lines:
+                if rows:
+                    write_batch(writer, schema, rows)
+                counts['rows'] += len(rows)
+                rows = []
+                batch = 0
+        if rows:
+            write_batch(writer, schema, rows)
+        counts['rows'] += len(rows)
+        writer.add_key_value_metadata({'counts': json.dumps(counts),
+                                       'source': src_path,
+                                       'source_stat': json.dumps(source),
+                                       'range': f'{start}-{end}'})
+
+    name = f'{src_path} [{start}, {end})'
+    if counts['failures']:
+        logger.warning(f'{name}: {counts["failures"]} of {counts["lines"]} lines failed, first: {first_failure}')
+
+    _, _, num_rows = read_part_metadata(tmp_path)
+    records = count_records(src_path, start, end)
+    if num_rows != counts['rows']:
+        error = f'wrote {num_rows} rows, expected {counts["rows"]}'
+    elif records != counts['lines']:
+        error = f'read {counts["lines"]} lines, the range has {records} records'
+    elif counts['failures'] > max(1, max_failure_rate * counts['lines']):
+        error = f'{counts["failures"]} of {counts["lines"]} lines failed, first: {first_failure}'
+    else:
+        os.replace(tmp_path, dst_path)
+        return counts
+    os.remove(tmp_path)
+    raise RuntimeError(error)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--srcdir', type=str, default=BASE_SAVE_DIR,
+                        help='Base directory of the JSON-lines files written by the collectors')
+    parser.add_argument('--outdir', type=str, default=BASE_OUT_DIR,
+                        help='Base directory of the Parquet files')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Number of worker processes')
+    parser.add_argument('--chunk_mb', type=int, default=CHUNK_MB,
+                        help='Size in MB of the byte ranges large files are split in. '
+                             'Changing it between a run and its resume reconverts all files.')
+    parser.add_argument('--batch_lines', type=int, default=BATCH_LINES,
+                        help='Number of source lines per Parquet row group')
+    parser.add_argument('--max_failure_rate', type=float, default=MAX_FAILURE_RATE,
+                        help='Fraction of lines of a part that may fail to parse before the part is rejected. '
+                             'A single failure (e.g. a truncated last line) is always accepted.')
+
+    parser_args = parser.parse_args()
+
+    return parser_args
+
+
+def main(args):
+    """
+    Converts every part that is not converted yet
+    Returns the number of parts that failed, which are converted again by the next run
+    """
+    chunk_bytes = args.chunk_mb * 1024 * 1024
+
+    tasks = []
+    skipped = 0
+    for pair, exchange, info_type, src_path in find_sources(args.srcdir):
+        out_dir = join(*[args.outdir, pair, exchange, info_type])
+        os.makedirs(out_dir, exist_ok=True)
+        source = source_stat(src_path)
+        planned_paths = set()
+        for start, end in split_ranges(src_path, chunk_bytes):
+            dst_path = part_path(out_dir, start, end)
+            planned_paths.add(dst_path)
+            if verify_part(dst_path, source):
+                skipped += 1
+                continue
+            tasks.append((src_path, source, exchange, info_type, start, end, dst_path,
+                          args.batch_lines, args.max_failure_rate))
+        remove_stale_parts(out_dir, planned_paths)
+    logger.info(f'Converting {len(tasks)} parts, {skipped} already converted')
+
+    totals = {'lines': 0, 'converted': 0, 'error_responses': 0, 'failures': 0, 'rows': 0}
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(convert_range, *task): task for task in tasks}
+        for future in as_completed(futures):
+            src_path, _, _, _, start, end, _, _, _ = futures[future]
+            try:
+                counts = future.result()
+            except Exception as e:
+                failed += 1
+                logger.error(f'Failed to convert {src_path} [{start}, {end}): {e}')
+                continue
+            for key in totals:
+                totals[key] += counts[key]
+            logger.info(f'Converted {src_path} [{start}, {end}): {counts}')
+
+    logger.info(f'Finished converting: {totals}, {failed} parts failed')
+    return failed
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    failed = main(args)
+    sys.exit(1 if failed else 0)
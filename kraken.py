@@ -13,6 +13,8 @@ from loguru import logger
 
 from easydict import EasyDict as edict
 
+from ratelimit import RateLimitError, get_governor, parse_retry_after, LIMITS, PRIORITIES
+
 
 # TODO: Eliminate duplicate function and mapping
 def map_currency(currency, currency_map):
@@ -43,7 +45,8 @@ KRAKEN_BASE_ARGS = edict({'time': None,
                           'granularity': 60,
                           'spreads': 0,
                           'trades': 0,
-                          'ticker': 0})
+                          'ticker': 0,
+                          'tier': 'public'})
 
 API_LINK = 'https://api.kraken.com/0/public/'
 KRAKEN_NAME_CONVENTION = {
@@ -55,30 +58,55 @@ INVERSE_KRAKEN_NAME_CONVENTION = {
     }
 
 BASE_SAVE_DIR = '../../datasets/'
+RATE_LIMIT_ERRORS = ('EAPI:Rate limit exceeded', 'EGeneral:Too many requests')
+REQUEST_TIMEOUT = 10
+
+
+def make_request(url):
+    """
+    Makes a request and returns the response
+    Raises RateLimitError if Kraken rejected the request for its rate
+    Raises requests.RequestException on connection errors, timeouts and HTTP errors
+    """
+    resp = requests.get(url, timeout=REQUEST_TIMEOUT)
+    retry_after = parse_retry_after(resp.headers)
+    if resp.status_code == 429:
+        raise RateLimitError(retry_after)
+    resp.raise_for_status()
+    resp = resp.json()
+    if any(error in RATE_LIMIT_ERRORS for error in resp['error']):
+        raise RateLimitError(retry_after)
+    return resp
 
 
 def get_order_book(pair, depth):
     """Returns order book by depth"""
     api_command = API_LINK + f'Depth?pair={pair}&count={depth}'
-    resp = requests.get(api_command).json()
+    resp = make_request(api_command)
     if not resp['error']:  # empty
         return resp
     return resp['error']
 
 
-def get_trades(pair, since):
+def get_trades(pair, since=None):
     """Returns last 1000 trades by default"""
-    api_command = API_LINK + f'Trades?pair={pair}&since={since}'
-    resp = requests.get(api_command).json()
+    if since is None:
+        api_command = API_LINK + f'Trades?pair={pair}'
+    else:
+        api_command = API_LINK + f'Trades?pair={pair}&since={since}'
+    resp = make_request(api_command)
     if not resp['error']:  # empty
         return resp
     return resp['error']
 
 
-def get_spreads(pair, since):
+def get_spreads(pair, since=None):
     """Returns last recent spreads"""
-    api_command = API_LINK + f'Spreads?pair={pair}&since={since}'
-    resp = requests.get(api_command).json()
+    if since is None:
+        api_command = API_LINK + f'Spreads?pair={pair}'
+    else:
+        api_command = API_LINK + f'Spreads?pair={pair}&since={since}'
+    resp = make_request(api_command)
     if not resp['error']:  # empty
         return resp
     return resp['error']
@@ -94,7 +122,7 @@ def get_candles(pair, granularity, since=None):
         api_command = API_LINK + f'OHLC?pair={pair}&interval={granularity}'
     else:
         api_command = API_LINK + f'OHLC?pair={pair}&interval={granularity}&since={since}'
-    resp = requests.get(api_command).json()
+    resp = make_request(api_command)
     if not resp['error']:  # empty
         return resp
     return resp['error']
@@ -106,25 +134,34 @@ def get_ticker(pair):
     Note:Today's prices start at midnight UTC
     """
     api_command = API_LINK + f'Ticker?pair={pair}'
-    resp = requests.get(api_command).json()
+    resp = make_request(api_command)
     if not resp['error']:  # empty
         return resp
     return resp['error']
 
 
-def store_info(save_dir, api_pair_symbol, pair_print_name, collection_time, info_type, **kwargs):
+def store_info(save_dir, api_pair_symbol, pair_print_name, collection_time, info_type, tier='public', **kwargs):
     """
     Logs API request response by
         info_type: FN_MAPPING.keys()
         timestamp: Unix time of request
+    Requests are rate limited by the governor shared by all kraken collectors of the API key tier
     """
     logger.info(f"Collecting {info_type} data for {pair_print_name} to {save_dir}")
+    governor = get_governor('kraken', tier)
     with open(join(save_dir, info_type) + '.txt', 'w') as file:
         start = time.time()
         while time.time() - start < collection_time:
+            ts, resp = governor.call(FN_MAPPING[info_type], priority=PRIORITIES[info_type],
+                                     pair=api_pair_symbol, **kwargs)
+            if resp is None:  # transient error, logged by the governor
+                continue
+            if isinstance(resp, list):  # errors
+                logger.warning(f'{info_type} request for {pair_print_name} failed: {resp}')
+                continue
             file.write(json.dumps({
-                'ts': time.time(),
-                'response': next(iter(FN_MAPPING[info_type](pair=api_pair_symbol, **kwargs)['result'].values()))
+                'ts': ts,
+                'response': next(iter(resp['result'].values()))
             }))
             file.write('\n')
 
@@ -172,6 +209,10 @@ def parse_arguments():
     # Ticker
     parser.add_argument('--ticker', type=int, default=0,
                         help='Gets snapshot information about the last trade (tick), best bid/ask and 24h volume.')
+    # Rate limit
+    parser.add_argument('--tier', type=str, default='public', choices=list(LIMITS['kraken'].keys()),
+                        help='API key tier, determines the rate limit shared by all requests. '
+                             'Only public endpoints are collected, so only the per-IP public limit applies.')
 
     parser_args = parser.parse_args()
 
@@ -194,6 +235,8 @@ def main(args):
     use_trades = args.trades
     # Ticker
     use_ticker = args.ticker
+    # Rate limit
+    tier = args.tier
 
     save_dir = join(*[args.savedir, pair, 'kraken'])
     os.makedirs(save_dir, exist_ok=True)
@@ -201,32 +244,35 @@ def main(args):
     if use_ticker:
         t = threading.Thread(target=store_info,
                              args=(save_dir, api_pair_symbol, pair, collection_time, 'ticker'),
+                             kwargs={'tier': tier}
                              )
         threads.append(t)
 
     if use_ob:
         t = threading.Thread(target=store_info,
                              args=(save_dir, api_pair_symbol, pair, collection_time, 'order_book'),
-                             kwargs={'depth': depth}
+                             kwargs={'depth': depth, 'tier': tier}
                              )
         threads.append(t)
 
     if use_spreads:
         t = threading.Thread(target=store_info,
                              args=(save_dir, api_pair_symbol, pair, collection_time, 'spread'),
+                             kwargs={'tier': tier}
                              )
         threads.append(t)
 
     if use_trades:
         t = threading.Thread(target=store_info,
                              args=(save_dir, api_pair_symbol, pair, collection_time, 'trades'),
+                             kwargs={'tier': tier}
                              )
         threads.append(t)
 
     if use_candles:
         t = threading.Thread(target=store_info,
                              args=(save_dir, api_pair_symbol, pair, collection_time, 'candles'),
-                             kwargs={'granularity': candles_granularity}
+                             kwargs={'granularity': candles_granularity, 'tier': tier}
                              )
         threads.append(t)
 
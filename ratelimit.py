@@ -0,0 +1,259 @@
+"""
+This module rate limits the requests made by the collectors
+
+General
+- One governor is shared by all threads collecting from the same exchange
+  with the same API key tier (see get_governor)
+- Each governor is a token bucket of capacity tokens refilled at rate tokens/s.
+  Kraken documents its limits as a counter that increases by the call cost and
+  decays at a fixed rate, which is the same bucket seen from the other side:
+  capacity = max counter, rate = decay rate.
+- Documented limits are in LIMITS, by exchange then tier:
+  kraken - https://docs.kraken.com/rest/#section/Rate-Limits
+  bybit  - https://bybit-exchange.github.io/docs/inverse/#t-ratelimits
+  cb_pro - https://docs.pro.coinbase.com/#rate-limits
+- The collectors only call public, unauthenticated endpoints, which are limited
+  per IP, so 'public' is the only tier. Private endpoint limits (Kraken's
+  starter/intermediate/pro counters, Coinbase's private 5 req/s) depend on the
+  API key and only belong here once a collector authenticates.
+
+Adaptive rate (AIMD)
+- Every successful request increases the rate so that it grows by
+  INCREASE_FRACTION of the documented rate per second, up to the documented rate
+- Every rate-limit error (429, EAPI:Rate limit exceeded, ret_code 10006, ...)
+  multiplies the rate by DECREASE_FACTOR (at most once per DECREASE_COOLDOWN),
+  empties the bucket and blocks all requests until Retry-After has passed.
+  Without Retry-After, all requests are blocked for BACKOFF_SECONDS, doubled on
+  every consecutive rate-limit error up to MAX_BACKOFF_SECONDS (Bybit answers
+  IP bans with a bare 403).
+- call gives up after MAX_RATE_LIMIT_ATTEMPTS consecutive rate-limit errors and
+  returns None as the result, so the collector gets back to its time check
+
+Transient errors
+- Connection errors, timeouts, HTTP errors (5xx) and non-JSON responses block all
+  requests for BACKOFF_SECONDS, doubled on every consecutive error up to
+  MAX_BACKOFF_SECONDS. They do not change the rate.
+- call returns None as the result so the collector logs nothing and moves on
+
+Priorities
+- When requests are waiting for tokens, the one with the lowest PRIORITIES value
+  goes first, so order book polls are served before ticker, candles and stats
+- Priorities age: a waiting request gains one priority level every AGING_TOKENS
+  tokens refilled, so when the budget is tight lower priority requests get a
+  smaller share of it instead of being starved (with AGING_TOKENS = 2, about one
+  token in 3 for priority 1 and one in 5 for priority 2)
+"""
+
+import time
+import json
+import threading
+from itertools import count
+from email.utils import parsedate_to_datetime
+from loguru import logger
+import requests
+
+
+class Limit:
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+
+
+LIMITS = {
+    'kraken': {
+        'public': Limit(capacity=1, rate=1.0),  # /0/public/*: about 1 req/s per IP
+    },
+    'bybit': {
+        'public': Limit(capacity=50, rate=50.0),  # /v2/public/*: 50 req/s per IP
+    },
+    'cb_pro': {
+        'public': Limit(capacity=6, rate=3.0),  # PublicClient: 3 req/s per IP, bursts of 6
+    },
+}
+
+PRIORITIES = {
+    'order_book': 0,
+    'trades': 1,
+    'ticker': 1,
+    'candles': 2,
+    'spread': 2,
+    'stats': 2,
+}
+
+INCREASE_FRACTION = 0.05
+DECREASE_FACTOR = 0.5
+DECREASE_COOLDOWN = 1.0
+MIN_RATE_FRACTION = 0.1
+AGING_TOKENS = 2.0
+MAX_WAIT = 0.1
+BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 60.0
+MAX_RATE_LIMIT_ATTEMPTS = 5
+
+# requests.JSONDecodeError is a RequestException, json.JSONDecodeError covers older requests
+TRANSIENT_ERRORS = (requests.RequestException, json.JSONDecodeError)
+
+
+class RateLimitError(Exception):
+    """Raised by a request function when the exchange rejected the request for its rate"""
+
+    def __init__(self, retry_after=None):
+        super().__init__(f'Rate limit exceeded, retry after {retry_after}s')
+        self.retry_after = retry_after
+
+
+def parse_retry_after(headers):
+    """
+    Returns the Retry-After header in seconds, or None
+    The header is either a number of seconds or an HTTP date
+    """
+    value = headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class RateGovernor:
+    def __init__(self, name, capacity, rate, clock=time.monotonic):
+        self.name = name
+        self.capacity = capacity
+        self.max_rate = rate
+        self.min_rate = rate * MIN_RATE_FRACTION
+        self.rate = rate
+        self.tokens = capacity
+        self.clock = clock
+        self.updated = clock()
+        self.blocked_until = 0.0
+        self.last_decrease = float('-inf')
+        self.consecutive_errors = 0
+        self.consecutive_rate_limits = 0
+        self.waiters = {}  # ticket: (priority, waiting since)
+        self.tickets = count()
+        self.condition = threading.Condition()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _first_waiter(self, now):
+        """
+        Returns the ticket of the waiting request with the highest aged priority
+        Ties go to the request that has waited the longest
+        """
+        def aged_priority(ticket):
+            priority, since = self.waiters[ticket]
+            return priority - (now - since) * self.rate / AGING_TOKENS, ticket
+        return min(self.waiters, key=aged_priority)
+
+    def _wait_time(self, ticket, cost, now):
+        """
+        Returns how long the request holding ticket has to wait, 0 if it can take its tokens now
+        """
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens < cost:
+            return (cost - self.tokens) / self.rate
+        if self._first_waiter(now) != ticket:
+            # Woken up once the first request took its tokens, bounded so aging is re-evaluated
+            return MAX_WAIT
+        return 0
+
+    def acquire(self, cost=1, priority=0):
+        """
+        Blocks until cost tokens are available and this request has the highest aged priority
+        """
+        with self.condition:
+            ticket = next(self.tickets)
+            self.waiters[ticket] = (priority, self.clock())
+            try:
+                while True:
+                    wait = self._wait_time(ticket, cost, self.clock())
+                    if wait <= 0:
+                        self.tokens -= cost
+                        return
+                    self.condition.wait(min(wait, MAX_WAIT))
+            finally:
+                del self.waiters[ticket]
+                self.condition.notify_all()
+
+    def on_success(self):
+        """Additive increase"""
+        with self.condition:
+            self.consecutive_errors = 0
+            self.consecutive_rate_limits = 0
+            self.rate = min(self.max_rate, self.rate + INCREASE_FRACTION * self.max_rate / self.rate)
+
+    def on_rate_limit(self, retry_after=None):
+        """Multiplicative decrease"""
+        with self.condition:
+            now = self.clock()
+            self._refill(now)
+            # Requests in flight when the limit was hit all fail together: decrease once for them
+            if now - self.last_decrease >= DECREASE_COOLDOWN:
+                self.rate = max(self.min_rate, self.rate * DECREASE_FACTOR)
+                self.last_decrease = now
+            self.tokens = 0
+            self.consecutive_rate_limits += 1
+            if retry_after is None:
+                retry_after = min(MAX_BACKOFF_SECONDS,
+                                  BACKOFF_SECONDS * 2 ** (self.consecutive_rate_limits - 1))
+            self.blocked_until = max(self.blocked_until, now + retry_after)
+            logger.warning(f'{self.name} rate limited, retry after {retry_after:.1f}s, '
+                           f'rate decreased to {self.rate:.2f} req/s')
+            self.condition.notify_all()
+
+    def on_transient_error(self, error):
+        """Exponential backoff"""
+        with self.condition:
+            self.consecutive_errors += 1
+            backoff = min(MAX_BACKOFF_SECONDS, BACKOFF_SECONDS * 2 ** (self.consecutive_errors - 1))
+            self.blocked_until = max(self.blocked_until, self.clock() + backoff)
+            logger.warning(f'{self.name} request failed ({type(error).__name__}: {error}), '
+                           f'backing off {backoff:.1f}s')
+            self.condition.notify_all()
+
+    def call(self, fn, *args, priority=0, cost=1, **kwargs):
+        """
+        Calls fn once the governor allows it, retrying up to MAX_RATE_LIMIT_ATTEMPTS
+        times while it raises RateLimitError
+        Returns the Unix time of the request and the result of fn, or None as the
+        result if the request failed with a transient error or kept being rate limited
+        """
+        for _ in range(MAX_RATE_LIMIT_ATTEMPTS):
+            self.acquire(cost=cost, priority=priority)
+            ts = time.time()
+            try:
+                result = fn(*args, **kwargs)
+            except RateLimitError as e:
+                self.on_rate_limit(e.retry_after)
+                continue
+            except TRANSIENT_ERRORS as e:
+                self.on_transient_error(e)
+                return ts, None
+            self.on_success()
+            return ts, result
+        logger.warning(f'{self.name} request still rate limited after {MAX_RATE_LIMIT_ATTEMPTS} attempts, skipping')
+        return ts, None
+
+
+_GOVERNORS = {}
+_GOVERNORS_LOCK = threading.Lock()
+
+
+def get_governor(exchange, tier='public'):
+    """
+    Returns the governor shared by all collectors of exchange with this API key tier
+    """
+    with _GOVERNORS_LOCK:
+        if (exchange, tier) not in _GOVERNORS:
+            limit = LIMITS[exchange][tier]
+            _GOVERNORS[(exchange, tier)] = RateGovernor(f'{exchange} ({tier})', limit.capacity, limit.rate)
+        return _GOVERNORS[(exchange, tier)]
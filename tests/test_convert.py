@@ -0,0 +1,128 @@
+import json
+import os
+
+import pytest
+import pyarrow.parquet as pq
+
+import convert
+
+SAMPLE_RESPONSES = {
+    ('kraken', 'order_book'): {'asks': [['46500.1', '0.5', 1612345678]],
+                               'bids': [['46499.9', '1.5', 1612345678], ['46499.8', '2.0', 1612345677]]},
+    ('kraken', 'trades'): [['46500.0', '0.1', 1612345678.123, 'b', 'l', ''],
+                           ['46499.0', '0.2', 1612345679.456, 's', 'm', '']],
+    ('kraken', 'candles'): [[1612345620, '46400.0', '46600.0', '46300.0', '46500.0', '46450.0', '12.5', 100]],
+    ('kraken', 'ticker'): {'a': ['46500.1', '1', '1.000'], 'b': ['46499.9', '2', '2.000'],
+                           'c': ['46500.0', '0.1'], 'v': ['100.0', '2500.0']},
+    ('kraken', 'spread'): [[1612345678, '46499.9', '46500.1']],
+    ('bybit', 'order_book'): [{'price': '46499.5', 'size': 100, 'side': 'Buy'},
+                              {'price': '46500.0', 'size': 200, 'side': 'Sell'},
+                              {'price': '46500.5', 'size': 300, 'side': 'Sell'}],
+    ('bybit', 'trades'): [{'price': 46500.0, 'qty': 10, 'side': 'Sell', 'time': '2021-02-03T09:41:18.000Z'}],
+    ('bybit', 'candles'): [{'open_time': 1612345620, 'open': '46400', 'high': '46600', 'low': '46300',
+                            'close': '46500', 'volume': '1000'}],
+    ('bybit', 'ticker'): [{'open_time': 1612345620, 'open': '46400', 'high': '46600', 'low': '46300',
+                           'close': '46500', 'volume': '1000'}],
+    ('cb_pro', 'order_book'): {'sequence': 1, 'bids': [['46499.9', '1.5', 3]], 'asks': [['46500.1', '0.5', 1]]},
+    ('cb_pro', 'trades'): [{'time': '2021-02-03T09:41:18.123Z', 'trade_id': 1, 'price': '46500.0',
+                            'size': '0.1', 'side': 'buy'}],
+    ('cb_pro', 'candles'): [[1612345620, 46300.0, 46600.0, 46400.0, 46500.0, 12.5]],
+    ('cb_pro', 'ticker'): {'trade_id': 1, 'price': '46500.0', 'size': '0.1', 'time': '2021-02-03T09:41:18Z',
+                           'bid': '46499.9', 'ask': '46500.1', 'volume': '2500.0'},
+    ('cb_pro', 'stats'): {'open': '46400', 'high': '46600', 'low': '46300', 'last': '46500',
+                          'volume': '2500', 'volume_30day': '75000'},
+}
+
+EXPECTED_ROWS = {
+    ('kraken', 'order_book'): [(1.0, convert.BID, 0, 46499.9, 1.5), (1.0, convert.BID, 1, 46499.8, 2.0),
+                               (1.0, convert.ASK, 0, 46500.1, 0.5)],
+    ('kraken', 'trades'): [(1.0, 1612345678.123, convert.BUY, 46500.0, 0.1),
+                           (1.0, 1612345679.456, convert.SELL, 46499.0, 0.2)],
+    ('bybit', 'order_book'): [(1.0, convert.BID, 0, 46499.5, 100.0), (1.0, convert.ASK, 0, 46500.0, 200.0),
+                              (1.0, convert.ASK, 1, 46500.5, 300.0)],
+    ('bybit', 'trades'): [(1.0, 1612345278.0, convert.SELL, 46500.0, 10.0)],
+    ('cb_pro', 'candles'): [(1.0, 1612345620.0, 46400.0, 46600.0, 46300.0, 46500.0, 12.5)],
+}
+
+
+def write_lines(path, records, trailing_newline=True):
+    with open(path, 'w') as file:
+        file.write('\n'.join(json.dumps(record) for record in records))
+        if trailing_newline:
+            file.write('\n')
+
+
+def test_every_normalizer_has_a_sample():
+    assert set(SAMPLE_RESPONSES) == {(exchange, info_type)
+                                     for exchange, normalizers in convert.NORMALIZER_MAPPING.items()
+                                     for info_type in normalizers}
+
+
+@pytest.mark.parametrize('exchange, info_type', sorted(SAMPLE_RESPONSES))
+def test_normalizer_matches_schema(exchange, info_type):
+    rows = convert.NORMALIZER_MAPPING[exchange][info_type](1.0, SAMPLE_RESPONSES[(exchange, info_type)])
+    assert rows
+    assert all(len(row) == len(convert.SCHEMAS[info_type]) for row in rows)
+    if (exchange, info_type) in EXPECTED_ROWS:
+        assert sorted(rows) == sorted(EXPECTED_ROWS[(exchange, info_type)])
+
+
+def test_is_error_response():
+    assert convert.is_error_response('bybit', 'too many visits')
+    assert convert.is_error_response('cb_pro', {'message': 'NotFound'})
+    assert not convert.is_error_response('bybit', SAMPLE_RESPONSES[('bybit', 'trades')])
+    assert not convert.is_error_response('cb_pro', SAMPLE_RESPONSES[('cb_pro', 'stats')])
+    assert not convert.is_error_response('kraken', SAMPLE_RESPONSES[('kraken', 'trades')])
+
+
+@pytest.mark.parametrize('chunk_bytes', [1, 7, 50, 10 ** 6])
+@pytest.mark.parametrize('trailing_newline', [True, False])
+def test_split_ranges_cover_file_on_line_boundaries(tmp_path, chunk_bytes, trailing_newline):
+    path = str(tmp_path / 'ticker.txt')
+    write_lines(path, [{'ts': i, 'response': 'x' * (i % 13)} for i in range(40)], trailing_newline)
+    data = open(path, 'rb').read()
+    line_starts = {0} | {i + 1 for i, byte in enumerate(data) if byte == ord('\n')}
+
+    ranges = convert.split_ranges(path, chunk_bytes)
+
+    assert ranges[0][0] == 0 and ranges[-1][1] == len(data)
+    assert all(end == next_start for (_, end), (next_start, _) in zip(ranges, ranges[1:]))
+    assert all(start < end and start in line_starts for start, end in ranges)
+    assert sum(convert.count_records(path, start, end) for start, end in ranges) == 40
+
+
+def test_convert_range_round_trip(tmp_path):
+    path = str(tmp_path / 'order_book.txt')
+    write_lines(path, [{'ts': 1.0, 'response': SAMPLE_RESPONSES[('bybit', 'order_book')]},
+                       {'ts': 2.0, 'response': 'too many visits'}])
+    dst_path = str(tmp_path / 'part.parquet')
+    source = convert.source_stat(path)
+
+    counts = convert.convert_range(path, source, 'bybit', 'order_book', 0, os.path.getsize(path), dst_path)
+
+    assert counts == {'lines': 2, 'converted': 1, 'error_responses': 1, 'failures': 0, 'rows': 3}
+    assert pq.read_table(dst_path).column('price').to_pylist() == [46499.5, 46500.0, 46500.5]
+    assert convert.verify_part(dst_path, source)
+    assert not convert.verify_part(dst_path, dict(source, size=source['size'] + 1))
+
+
+def test_convert_range_rejects_failures(tmp_path):
+    path = str(tmp_path / 'order_book.txt')
+    write_lines(path, [{'ts': 1.0, 'response': [{'px': '1', 'side': 'Buy'}]}] * 3)
+    dst_path = str(tmp_path / 'part.parquet')
+
+    with pytest.raises(RuntimeError, match='3 of 3 lines failed'):
+        convert.convert_range(path, convert.source_stat(path), 'bybit', 'order_book',
+                              0, os.path.getsize(path), dst_path)
+    assert os.listdir(tmp_path) == ['order_book.txt']
+
+
+def test_remove_stale_parts(tmp_path):
+    planned = str(tmp_path / 'part-000000000000000-000000000000033.parquet')
+    stale = [str(tmp_path / 'part-000000000000000-000000000000022.parquet'), planned + '.tmp']
+    for path in [planned] + stale:
+        open(path, 'w').close()
+
+    convert.remove_stale_parts(str(tmp_path), {planned})
+
+    assert os.listdir(tmp_path) == [os.path.basename(planned)]
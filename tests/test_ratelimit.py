@@ -0,0 +1,151 @@
+import pytest
+import requests
+
+import ratelimit
+
+
+class FakeClock:
+    """Clock that only moves when told to, or by step on every read"""
+
+    def __init__(self, step=0.0):
+        self.now = 1000.0
+        self.step = step
+
+    def __call__(self):
+        self.now += self.step
+        return self.now
+
+
+def make_governor(capacity=1, rate=1.0, step=0.0):
+    clock = FakeClock(step)
+    return ratelimit.RateGovernor('test', capacity, rate, clock=clock), clock
+
+
+def enqueue(governor, priority, since=None):
+    ticket = next(governor.tickets)
+    governor.waiters[ticket] = (priority, governor.clock.now if since is None else since)
+    return ticket
+
+
+def test_token_bucket_refill():
+    governor, clock = make_governor(capacity=2, rate=4.0)
+    ticket = enqueue(governor, 0)
+    governor.tokens = 0
+
+    assert governor._wait_time(ticket, 1, clock.now) == pytest.approx(0.25)
+    clock.now += 0.25
+    assert governor._wait_time(ticket, 1, clock.now) == 0
+    clock.now += 10
+    governor._refill(clock.now)
+    assert governor.tokens == 2
+
+
+def test_higher_priority_goes_first():
+    governor, clock = make_governor()
+    ticker = enqueue(governor, ratelimit.PRIORITIES['ticker'])
+    order_book = enqueue(governor, ratelimit.PRIORITIES['order_book'])
+
+    assert governor._first_waiter(clock.now) == order_book
+    assert governor._wait_time(ticker, 1, clock.now) == ratelimit.MAX_WAIT
+    assert governor._wait_time(order_book, 1, clock.now) == 0
+
+
+def test_waiting_requests_age():
+    governor, clock = make_governor(rate=1.0)
+    stats = enqueue(governor, ratelimit.PRIORITIES['stats'])
+    # Two priority levels behind: overtakes a fresh order book request after 2 levels of aging
+    clock.now += 2 * ratelimit.AGING_TOKENS + 0.1
+    order_book = enqueue(governor, ratelimit.PRIORITIES['order_book'])
+
+    assert governor._first_waiter(clock.now) == stats
+    del governor.waiters[stats]
+    assert governor._first_waiter(clock.now) == order_book
+
+
+def test_rate_limit_decreases_once_per_cooldown():
+    governor, clock = make_governor(capacity=5, rate=10.0)
+
+    governor.on_rate_limit(retry_after=3)
+    governor.on_rate_limit()
+    assert governor.rate == 10.0 * ratelimit.DECREASE_FACTOR
+    assert governor.tokens == 0
+    assert governor.blocked_until == clock.now + 3
+
+    clock.now += ratelimit.DECREASE_COOLDOWN
+    for _ in range(20):
+        governor.on_rate_limit()
+        clock.now += ratelimit.DECREASE_COOLDOWN
+    assert governor.rate == governor.min_rate
+
+
+def test_success_increases_up_to_documented_rate():
+    governor, _ = make_governor(rate=10.0)
+    governor.rate = 5.0
+
+    governor.on_success()
+    assert governor.rate == pytest.approx(5.0 + ratelimit.INCREASE_FRACTION * 10.0 / 5.0)
+    for _ in range(1000):
+        governor.on_success()
+    assert governor.rate == governor.max_rate
+
+
+def test_call_retries_rate_limited_requests():
+    governor, _ = make_governor(capacity=1, rate=1.0, step=1.0)
+    responses = [ratelimit.RateLimitError(), ratelimit.RateLimitError(), 'ok']
+
+    def request():
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    _, result = governor.call(request)
+    assert result == 'ok'
+    assert responses == []
+    assert governor.rate < governor.max_rate
+
+
+def test_call_gives_up_on_persistent_rate_limit():
+    governor, clock = make_governor(capacity=50, rate=50.0, step=5.0)
+    attempts = []
+
+    def request():
+        attempts.append(clock.now)
+        raise ratelimit.RateLimitError()  # e.g. bybit 403 during an IP ban
+
+    _, result = governor.call(request)
+    assert result is None
+    assert len(attempts) == ratelimit.MAX_RATE_LIMIT_ATTEMPTS
+    assert governor.consecutive_rate_limits == ratelimit.MAX_RATE_LIMIT_ATTEMPTS
+    # Blocked for 1, 2, 4, 8s between attempts, then 16s after the last one
+    gaps = [later - earlier for earlier, later in zip(attempts, attempts[1:])]
+    assert all(gap >= backoff * ratelimit.BACKOFF_SECONDS for gap, backoff in zip(gaps, (1, 2, 4, 8)))
+    assert governor.blocked_until >= attempts[-1] + 16 * ratelimit.BACKOFF_SECONDS
+
+    governor.blocked_until = 0
+    governor.call(lambda: 'ok')
+    assert governor.consecutive_rate_limits == 0
+
+
+def test_call_backs_off_on_transient_errors():
+    governor, clock = make_governor(capacity=5, rate=10.0, step=0.01)
+
+    def request():
+        raise requests.ConnectionError('connection reset')
+
+    for backoff in (1, 2, 4):
+        _, result = governor.call(request)
+        assert result is None
+        assert governor.blocked_until == pytest.approx(clock.now + backoff * ratelimit.BACKOFF_SECONDS)
+        clock.now = governor.blocked_until
+    assert governor.rate == 10.0
+
+    governor.call(lambda: 'ok')
+    assert governor.consecutive_errors == 0
+
+
+def test_parse_retry_after():
+    assert ratelimit.parse_retry_after({'Retry-After': '2'}) == 2.0
+    assert ratelimit.parse_retry_after({'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}) == 0
+    assert ratelimit.parse_retry_after({'Retry-After': 'soon'}) is None
+    assert ratelimit.parse_retry_after({}) is None